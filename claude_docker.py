@@ -3,29 +3,28 @@
 
 import argparse
 import atexit
-import base64
-import hashlib
+import functools
 import json
 import os
 import re
+import shlex
 import shutil
 import signal
 import subprocess
 import sys
 import threading
 import time
-import urllib.error
-import urllib.request
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Optional
-from zoneinfo import ZoneInfo
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
 
 
 # Configuration
 SCRIPT_DIR = Path(__file__).resolve().parent
 IMAGE_NAME = "claude-code"
+_HOME = str(Path.home()).rstrip("/")  # as expanduser joins it
 CONFIG_DIR = Path.home() / ".claude-docker"
 SHARED_DIR = CONFIG_DIR / "shared"
 CREDENTIALS = Path.home() / ".claude" / ".credentials.json"
@@ -36,6 +35,31 @@ C3PO_CREDS_FILE = CONFIG_DIR / "c3po-credentials.json"
 USER_CONFIG = SHARED_DIR / ".claude.json"
 DOCKER_YAML_CONFIG = CONFIG_DIR / "claude-docker.yaml"
 AGENTS_FILE = CONFIG_DIR / "agents.yaml"
+AGENTS_CACHE_FILE = CONFIG_DIR / ".agents-cache.json"
+RUNTIME_CACHE_FILE = CONFIG_DIR / ".runtime"
+BUILD_HASH_CACHE_FILE = CONFIG_DIR / ".build-hash-cache"
+RUNTIME_CACHE_TTL = 24 * 3600  # seconds before runtime/sudo detection is redone
+
+# Default claude-docker.yaml written on first setup or direct prompt
+_DEFAULT_DOCKER_YAML = f"""streamLogging:
+  enabled: true
+  directory: {CONFIG_DIR / "session-logs"}
+  retentionDays: 30
+  maxFileSizeMB: 10
+""".encode()
+
+# Bind mounts whose host paths never change within a run
+_SHARED_DIR_MOUNT = ("-v", f"{SHARED_DIR}:/home/node/.claude")
+_CREDENTIALS_MOUNT = ("-v", f"{CREDENTIALS}:/home/node/.claude/.credentials.json:ro")
+_DOCKER_YAML_MOUNT = ("-v", f"{DOCKER_YAML_CONFIG}:/home/node/claude-docker.yaml")
+_USER_CONFIG_MOUNT = ("-v", f"{USER_CONFIG}:/home/node/.claude.json")
+
+# OAuth token in `claude setup-token` output: prefer one followed by whitespace or
+# punctuation, else fall back to a bare token of the expected length.
+_TOKEN_RE = re.compile(r'(sk-ant-[a-zA-Z0-9_-]+|sk-at-[a-zA-Z0-9_-]+)(?=\s|[.,!]|$)')
+_TOKEN_FALLBACK_RE = re.compile(r'(sk-ant-[a-zA-Z0-9_-]{90,110}|sk-at-[a-zA-Z0-9_-]{90,110})')
+_VERSION_RE = re.compile(r'\d+\.\d+\.\d+')
+_DURATION_RE = re.compile(r"(\d+)(s|m|h|d)")
 
 
 class ClaudeDocker:
@@ -45,10 +69,14 @@ class ClaudeDocker:
         self._running_container: Optional[str] = None
         self._runtime: Optional[str] = None
         self._needs_sudo: Optional[bool] = None
+        # build.hash label per runtime command; None means the image is missing
+        self._image_hashes: Dict[tuple, Optional[str]] = {}
 
     @property
     def runtime(self) -> str:
         """Get or detect container runtime."""
+        if self._runtime is None:
+            self._load_runtime_cache()
         if self._runtime is None:
             self._runtime = self._detect_runtime()
         return self._runtime
@@ -59,23 +87,43 @@ class ClaudeDocker:
         rt = self.runtime
         if self._needs_sudo is None:
             # Check if the runtime works without sudo
-            result = subprocess.run(
-                [rt, "info"], capture_output=True, env=os.environ
-            )
+            result = subprocess.run([rt, "info"], capture_output=True)
             if result.returncode != 0:
                 # Try with sudo
-                result = subprocess.run(
-                    ["sudo", "-n", rt, "info"], capture_output=True, env=os.environ
-                )
+                result = subprocess.run(["sudo", "-n", rt, "info"], capture_output=True)
                 self._needs_sudo = result.returncode == 0
+                if self._needs_sudo:
+                    self._save_runtime_cache()
             else:
                 self._needs_sudo = False
+                self._save_runtime_cache()
         return ["sudo", rt] if self._needs_sudo else [rt]
 
+    def _load_runtime_cache(self) -> None:
+        """Adopt the runtime and sudo choice persisted by a recent run, if still valid."""
+        try:
+            if time.time() - RUNTIME_CACHE_FILE.stat().st_mtime > RUNTIME_CACHE_TTL:
+                return
+            data = json.loads(RUNTIME_CACHE_FILE.read_text())
+            rt, needs_sudo = data["runtime"], data["sudo"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        if rt in ("docker", "nerdctl", "finch") and shutil.which(rt):
+            self._runtime = rt
+            self._needs_sudo = bool(needs_sudo)
+
+    def _save_runtime_cache(self) -> None:
+        """Persist a runtime whose `info` probe succeeded so later runs skip detection."""
+        _atomic_write_text(RUNTIME_CACHE_FILE,
+                           json.dumps({"runtime": self._runtime, "sudo": self._needs_sudo}))
+
     def _detect_runtime(self) -> str:
-        """Auto-select docker, nerdctl, or finch."""
+        """Auto-select docker, nerdctl, or finch.
+
+        Uses an in-process PATH lookup rather than forking `which` per candidate.
+        """
         for rt in ("docker", "nerdctl", "finch"):
-            if subprocess.run(["which", rt], capture_output=True, env=os.environ).returncode == 0:
+            if shutil.which(rt):
                 return rt
         print("Error: No container runtime found. Install docker, nerdctl, or finch.", file=sys.stderr)
         sys.exit(1)
@@ -90,6 +138,14 @@ class ClaudeDocker:
                 pass
             self._running_container = None
 
+    def forget_container(self) -> None:
+        """Drop the running container after the runtime client exited on its own.
+
+        The container is gone by then (--rm), so there is nothing to stop.
+        Signal-driven cleanup still uses a graceful stop so c3po session hooks run.
+        """
+        self._running_container = None
+
     def signal_handler(self, signum, frame):
         """Handle SIGINT and SIGTERM to cleanup container."""
         self.cleanup_container()
@@ -120,14 +176,69 @@ def signal_handler(signum, frame):
     claude_docker.signal_handler(signum, frame)
 
 
-def build_hash() -> str:
-    """Compute SHA-256 hash of Dockerfile + entrypoint.sh."""
+_BUILD_FILES = ("Dockerfile", "entrypoint.sh")
+
+
+def _build_files_key() -> Optional[List]:
+    """Identify the current build inputs by path, mtime and size."""
+    try:
+        stats = [(SCRIPT_DIR / name).stat() for name in _BUILD_FILES]
+    except OSError:
+        return None
+    return [[str(SCRIPT_DIR / name), st.st_mtime_ns, st.st_size]
+            for name, st in zip(_BUILD_FILES, stats)]
+
+
+def _hash_build_files() -> str:
+    """SHA-256 over Dockerfile + entrypoint.sh."""
+    import hashlib
+    import mmap
     h = hashlib.sha256()
-    h.update((SCRIPT_DIR / "Dockerfile").read_bytes())
-    h.update((SCRIPT_DIR / "entrypoint.sh").read_bytes())
+    for name in _BUILD_FILES:
+        # Hash the mapped pages in place (no bytes copy); one hasher over both
+        # files keeps the digest equal to sha256(Dockerfile + entrypoint.sh)
+        with open(SCRIPT_DIR / name, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                continue  # mmap rejects empty files
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
     return h.hexdigest()
 
 
+@functools.lru_cache(maxsize=1)
+def build_hash() -> str:
+    """Compute SHA-256 hash of Dockerfile + entrypoint.sh (once per process).
+
+    The digest is also kept in BUILD_HASH_CACHE_FILE and reused by later runs
+    while both files keep the same mtime and size.
+    """
+    key = _build_files_key()
+    if key is not None:
+        try:
+            entry = json.loads(BUILD_HASH_CACHE_FILE.read_text())
+            if entry["key"] == key:
+                return entry["hash"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    digest = _hash_build_files()
+    if key is not None:
+        _atomic_write_text(BUILD_HASH_CACHE_FILE, json.dumps({"key": key, "hash": digest}))
+    return digest
+
+
+def _atomic_write_text(path: Path, text: str) -> None:
+    """Best-effort private (0600) write via a temp file and rename."""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}")
+        fd = os.open(str(tmp), os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
 def _migrate_to_shared_dir():
     """One-time migration: move Claude state files from CONFIG_DIR root into shared/.
 
@@ -174,6 +285,26 @@ def _write_credentials_to(config_dir: Path) -> None:
             dst.chmod(0o644)
 
 
+@functools.lru_cache(maxsize=1)
+def _token_file_content() -> Optional[str]:
+    """Read the stored OAuth token once per process (None if there is no token file)."""
+    try:
+        return TOKEN_FILE.read_text().strip()
+    except FileNotFoundError:
+        return None
+
+
+@functools.lru_cache(maxsize=1)
+def _has_host_credentials() -> bool:
+    """Check once per process whether host ~/.claude/.credentials.json exists."""
+    return CREDENTIALS.exists()
+
+
+def _oauth_token() -> Optional[str]:
+    """Return the OAuth token: CLAUDE_CODE_OAUTH_TOKEN env var, else the token file."""
+    return os.environ.get("CLAUDE_CODE_OAUTH_TOKEN") or _token_file_content()
+
+
 def get_agent_config_dir(agent_name: str) -> Path:
     """Get per-agent config dir, writing credentials fresh on every launch."""
     agent_dir = CONFIG_DIR / "agents" / agent_name
@@ -202,6 +333,35 @@ def _as_cmd(runtime) -> List[str]:
     return [runtime] if isinstance(runtime, str) else list(runtime)
 
 
+def _image_build_hash(runtime) -> Optional[str]:
+    """Return the image's build.hash label, or None if the image is missing.
+
+    The inspect result is cached per runtime command for the rest of the
+    process; build_image() invalidates it.
+    """
+    rt_cmd = _as_cmd(runtime)
+    key = tuple(rt_cmd)
+    if key in claude_docker._image_hashes:
+        return claude_docker._image_hashes[key]
+
+    image_hash = None
+    result = subprocess.run(
+        rt_cmd + ["image", "inspect", IMAGE_NAME],
+        capture_output=True, text=True
+    )
+    if result.returncode == 0:
+        try:
+            data = json.loads(result.stdout)
+            # docker returns a list, nerdctl may return a dict or list
+            if isinstance(data, list):
+                data = data[0]
+            image_hash = data.get("Config", {}).get("Labels", {}).get("build.hash", "")
+        except (json.JSONDecodeError, IndexError, KeyError):
+            pass
+    claude_docker._image_hashes[key] = image_hash
+    return image_hash
+
+
 def needs_rebuild(runtime) -> bool:
     """Check if image needs rebuilding.
 
@@ -211,22 +371,8 @@ def needs_rebuild(runtime) -> bool:
     if os.environ.get("CLAUSE_DOCKER_FORCE_BUILD") == "1":
         return True
 
-    rt_cmd = _as_cmd(runtime)
-    result = subprocess.run(
-        rt_cmd + ["image", "inspect", IMAGE_NAME],
-        capture_output=True, text=True,
-        env=os.environ
-    )
-    if result.returncode != 0:
-        return True
-
-    try:
-        data = json.loads(result.stdout)
-        # docker returns a list, nerdctl may return a dict or list
-        if isinstance(data, list):
-            data = data[0]
-        image_hash = data.get("Config", {}).get("Labels", {}).get("build.hash", "")
-    except (json.JSONDecodeError, IndexError, KeyError):
+    image_hash = _image_build_hash(runtime)
+    if image_hash is None:
         return True
     return image_hash != build_hash()
 
@@ -240,6 +386,7 @@ def needs_cli_update() -> bool:
     if not installed:
         return False
     try:
+        import urllib.request
         req = urllib.request.Request(
             "https://registry.npmjs.org/@anthropic-ai/claude-code/latest",
             headers={"Accept": "application/json"}
@@ -262,25 +409,67 @@ def build_image(runtime, no_cache: bool = False) -> None:
         runtime: Runtime name (str) or command prefix (list), e.g. "docker" or ["sudo", "nerdctl"].
     """
     rt_cmd = _as_cmd(runtime)
+    via_sudo = rt_cmd[0] == "sudo"
     build_args = ["build"]
     if no_cache:
         build_args.append("--no-cache")
+    # nerdctl/finch always use BuildKit but treat --cache-from as a registry
+    # ref, so only docker gets the inline cache and the local image as a source
+    if os.path.basename(rt_cmd[-1]) == "docker":
+        # Record cache metadata in the image so later builds can reuse its layers
+        build_args.extend(["--build-arg", "BUILDKIT_INLINE_CACHE=1"])
+        if not no_cache and _image_build_hash(rt_cmd) is not None:
+            build_args.extend(["--cache-from", IMAGE_NAME])
     cmd = rt_cmd + build_args + ["--label", f"build.hash={build_hash()}", "-t", IMAGE_NAME]
     cmd.append(str(SCRIPT_DIR))
-    subprocess.run(cmd, check=True)
+    # sudo's env_reset would drop it anyway, and passing it as a sudo argument
+    # needs SETENV, which a single-command NOPASSWD rule doesn't grant
+    env = None if via_sudo else {**os.environ, "DOCKER_BUILDKIT": "1"}
+    subprocess.run(cmd, check=True, env=env)
+    claude_docker._image_hashes.clear()
     # Cache the installed CLI version for update checks
     result = subprocess.run(
         rt_cmd + ["run", "--rm", IMAGE_NAME, "--version"],
         capture_output=True, text=True
     )
     if result.returncode == 0:
-        import re
-        match = re.search(r'\d+\.\d+\.\d+', result.stdout)
+        match = _VERSION_RE.search(result.stdout)
         if match:
             CONFIG_DIR.mkdir(parents=True, exist_ok=True)
             (CONFIG_DIR / ".claude-cli-version").write_text(match.group(0))
 
 
+def _agents_cache_key() -> Optional[Dict]:
+    """Identify the current AGENTS_FILE contents by path, mtime and size."""
+    try:
+        st = AGENTS_FILE.stat()
+    except OSError:
+        return None
+    return {"path": str(AGENTS_FILE), "mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+
+def _read_agents_cache(key: Dict) -> Optional[Dict]:
+    """Return the cached entry for key, or None on a miss."""
+    try:
+        entry = json.loads(AGENTS_CACHE_FILE.read_text())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get("key") != key:
+        return None
+    return entry
+
+
+def _write_agents_cache(key: Dict, data) -> None:
+    """Best-effort write of parsed agents data, skipped if it doesn't survive JSON."""
+    try:
+        encoded = json.dumps({"key": key, "data": data})
+        if json.loads(encoded)["data"] != data:
+            return  # e.g. non-string keys or YAML dates
+    except (TypeError, ValueError):
+        return
+    _atomic_write_text(AGENTS_CACHE_FILE, encoded)
+
+
 def load_agents(yaml_content: str = None) -> Optional[Dict]:
     """Load and parse agents.yaml with PyYAML.
 
@@ -288,23 +477,35 @@ def load_agents(yaml_content: str = None) -> Optional[Dict]:
     by injecting 'prompt: /c3po auto', then writes the file back. This ensures every
     agent always has an explicit prompt after first load.
 
+    The parsed (post-migration) result is cached as JSON in AGENTS_CACHE_FILE, keyed
+    by the file's path, mtime and size, so unchanged files skip YAML parsing.
+
     Args:
         yaml_content: Optional YAML string to parse. If not provided, reads from AGENTS_FILE.
     """
+    if yaml_content is None:
+        # No yaml_content provided - try to read from file. The cache key's
+        # stat doubles as the existence check.
+        cache_key = _agents_cache_key()
+        if cache_key is None:
+            return None
+        cached = _read_agents_cache(cache_key)
+        if cached is not None:
+            return cached["data"]
+
     try:
         import yaml
     except ImportError:
         print(f"Error: PyYAML is required. Run: pip install pyyaml", file=sys.stderr)
         sys.exit(1)
+    # libyaml's C loader is much faster; fall back when PyYAML was built without it
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
     if yaml_content is not None:
-        return yaml.safe_load(yaml_content)
+        return yaml.load(yaml_content, Loader=loader)
 
-    # No yaml_content provided - try to read from file
-    if not AGENTS_FILE.exists():
-        return None
     with open(AGENTS_FILE) as f:
-        data = yaml.safe_load(f)
+        data = yaml.load(f, Loader=loader)
 
     if not isinstance(data, dict):
         return data
@@ -321,29 +522,71 @@ def load_agents(yaml_content: str = None) -> Optional[Dict]:
 
     if migrated:
         with open(AGENTS_FILE, "w") as f:
-            yaml.dump(data, f, default_flow_style=False, allow_unicode=True)
+            yaml.dump(data, f, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper),
+                      default_flow_style=False, allow_unicode=True)
         print(
             f"Migrated agents.yaml: added 'prompt: /c3po auto' to: {', '.join(migrated)}",
             file=sys.stderr,
         )
+        cache_key = _agents_cache_key()
+
+    if cache_key:
+        _write_agents_cache(cache_key, data)
 
     return data
 
 
-@dataclass(frozen=True)
+# __slots__ where dataclasses support it (3.10+); macOS system python is 3.9
+_DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+# Shared read-only default so agents without env don't each allocate a dict.
+# Dataclasses reject unhashable defaults, hence the factory below.
+_EMPTY_ENV: Mapping[str, str] = MappingProxyType({})
+
+
+@dataclass(frozen=True, **_DATACLASS_SLOTS)
 class AgentConfig:
     """Represents an agent's configuration."""
     name: str
     workspace: str
     model: Optional[str] = None
-    env: Dict[str, str] = field(default_factory=dict)
-    init: List[str] = field(default_factory=list)
+    env: Mapping[str, str] = field(default_factory=lambda: _EMPTY_ENV)
+    init: Sequence[str] = ()
     prompt: Optional[str] = None
-    triggers: List[dict] = field(default_factory=list)
-    post_run: List[str] = field(default_factory=list)
+    triggers: Sequence[dict] = ()
+    post_run: Sequence[str] = ()
     wait_first: bool = False
     readonly: bool = False
 
+    def __eq__(self, other):
+        # Hand-written so the name, which nearly always differs, short-circuits
+        # the comparison; dataclass keeps this and still derives __hash__.
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (
+            self.name == other.name
+            and self.workspace == other.workspace
+            and self.model == other.model
+            and self.env == other.env
+            and self.init == other.init
+            and self.prompt == other.prompt
+            and self.triggers == other.triggers
+            and self.post_run == other.post_run
+            and self.wait_first == other.wait_first
+            and self.readonly == other.readonly
+        )
+
+
+def _expand_home(path: str) -> str:
+    """os.path.expanduser with the common `~` / `~/...` case resolved from _HOME."""
+    if not path.startswith("~"):
+        return path
+    if path == "~":
+        return _HOME or "/"
+    if path.startswith("~/"):
+        return _HOME + path[1:]
+    return os.path.expanduser(path)  # ~user/...
+
 
 def get_agent_config(name: str, agents: Dict) -> Optional[AgentConfig]:
     """Extract agent configuration from parsed YAML.
@@ -355,23 +598,23 @@ def get_agent_config(name: str, agents: Dict) -> Optional[AgentConfig]:
         return None
 
     if isinstance(raw, str):
-        workspace = os.path.expanduser(raw)
+        workspace = _expand_home(raw)
         if not workspace:
             return None
         return AgentConfig(name=name, workspace=workspace)
     elif isinstance(raw, dict):
-        workspace = os.path.expanduser(raw.get("workspace", ""))
+        workspace = _expand_home(raw.get("workspace", ""))
         if not workspace:
             return None
         agent_config = AgentConfig(
             name=name,
             workspace=workspace,
             model=raw.get("model"),
-            env=raw.get("env", {}) or {},
-            init=raw.get("init", []) or [],
+            env=raw.get("env") or _EMPTY_ENV,
+            init=raw.get("init") or (),
             prompt=raw.get("prompt"),
-            triggers=raw.get("triggers", []) or [],
-            post_run=raw.get("post_run", []) or [],
+            triggers=raw.get("triggers") or (),
+            post_run=raw.get("post_run") or (),
             wait_first=bool(raw.get("wait_first", False)),
             readonly=bool(raw.get("readonly", False)),
         )
@@ -386,16 +629,16 @@ def get_agent_config(name: str, agents: Dict) -> Optional[AgentConfig]:
 def list_agents(agents: Dict, output_file=None, file=None) -> None:
     """Print formatted list of agents."""
     output = output_file or file or sys.stdout
-    print("Available agents:", file=output)
+    lines = ["Available agents:"]
     for name, config in agents.items():
         if isinstance(config, str):
             workspace = config
-            print(f"  {name:<15} {workspace}", file=output)
+            lines.append(f"  {name:<15} {workspace}")
         elif isinstance(config, dict):
             workspace = config.get("workspace", "")
             model = config.get("model")
             env_count = len(config.get("env", {}) or {})
-            init_count = len(config.get("init", []) or {})
+            init_count = len(config.get("init", []) or [])
 
             parts = [f"  {name:<15} {workspace}"]
             if model:
@@ -407,19 +650,27 @@ def list_agents(agents: Dict, output_file=None, file=None) -> None:
                 extras.append(f"init: {init_count}")
             if extras:
                 parts.append(f"[{' '.join(extras)}]")
-            print(" ".join(parts), file=output)
+            lines.append(" ".join(parts))
+    # One write instead of a print (and possible flush) per agent
+    output.write("\n".join(lines) + "\n")
 
 
 def encode_init_commands(init_list: List[str]) -> str:
     """Convert init commands list to base64-encoded JSON."""
-    json_str = json.dumps(init_list)
-    return base64.b64encode(json_str.encode()).decode()
+    import base64
+    try:
+        import orjson  # optional; emits compact UTF-8 bytes directly
+        payload = orjson.dumps(init_list)
+    except ImportError:
+        payload = json.dumps(init_list, separators=(",", ":")).encode()
+    return base64.b64encode(payload).decode("ascii")
 
 
 def decode_init_commands(encoded: str) -> List[str]:
     """Decode base64-encoded JSON back to command list."""
-    json_str = base64.b64decode(encoded).decode()
-    return json.loads(json_str)
+    import base64
+    # json.loads takes the UTF-8 bytes as-is
+    return json.loads(base64.b64decode(encoded))
 
 
 def _load_c3po_creds():
@@ -445,6 +696,7 @@ def _c3po_unregister(agent_id: str, url: str, headers: dict) -> None:
     if not agent_id or not url:
         return
     try:
+        import urllib.request
         data = json.dumps({"agent_id": agent_id}).encode()
         req = urllib.request.Request(
             f"{url}/agent/api/unregister",
@@ -470,10 +722,9 @@ def _c3po_claim_name(config: "AgentConfig") -> Optional[str]:
         mounts.extend(["-v", f"{agent_claude_json}:/home/node/.claude.json"])
 
     env_args = []
-    if os.environ.get("CLAUDE_CODE_OAUTH_TOKEN"):
-        env_args.extend(["-e", f"CLAUDE_CODE_OAUTH_TOKEN={os.environ['CLAUDE_CODE_OAUTH_TOKEN']}"])
-    elif TOKEN_FILE.exists():
-        env_args.extend(["-e", f"CLAUDE_CODE_OAUTH_TOKEN={TOKEN_FILE.read_text().strip()}"])
+    token = _oauth_token()
+    if token:
+        env_args.extend(["-e", f"CLAUDE_CODE_OAUTH_TOKEN={token}"])
 
     script = (
         'SCRIPT=$(find ~/.claude/plugins -path "*/c3po*/scripts/c3po-claim-name" -print 2>/dev/null | sort -V | tail -1); '
@@ -510,6 +761,8 @@ def _c3po_claim_name(config: "AgentConfig") -> Optional[str]:
 def _c3po_wait_thread(agent_id: str, url: str, headers: dict,
                       done_event: threading.Event, stop_event: threading.Event) -> None:
     """Thread function: long-poll C-3PO inbox until a message is pending."""
+    import urllib.error
+    import urllib.request
     # Agent ID goes in X-Machine-Name header (full machine/project string)
     poll_headers = {**headers, "X-Machine-Name": agent_id}
 
@@ -584,7 +837,7 @@ def _parse_interval_duration(s: str) -> timedelta:
 
     Raises ValueError on invalid input.
     """
-    m = re.fullmatch(r"(\d+)(s|m|h|d)", s)
+    m = _DURATION_RE.fullmatch(s)
     if not m:
         raise ValueError(f"Invalid duration '{s}': expected format like 30s, 15m, 4h, 1d")
     value = int(m.group(1))
@@ -612,6 +865,7 @@ def _validate_trigger(trigger: dict) -> Optional[str]:
         if not tz_name:
             return "schedule trigger missing 'timezone' field"
         try:
+            from zoneinfo import ZoneInfo
             ZoneInfo(tz_name)
         except Exception:
             return f"schedule trigger has invalid timezone '{tz_name}'"
@@ -660,6 +914,7 @@ def _schedule_trigger_thread(cron_expr: str, tz_name: str, done_event: threading
     except Exception:
         print("Error: croniter package not available; cannot use schedule trigger", file=sys.stderr)
         return
+    from zoneinfo import ZoneInfo
 
     now = datetime.now(ZoneInfo(tz_name))
     next_fire = croniter(cron_expr, now).get_next(datetime)
@@ -895,37 +1150,46 @@ def _run_trigger_loop(
                 print(f"post_run error '{cmd}': {e}", file=sys.stderr)
 
 
+def _stream_settings(args: argparse.Namespace, stream: bool = True) -> Tuple[bool, bool]:
+    """Apply -s / -sj / --no-stream to a mode's default stream setting.
+
+    All three store into args.stream_mode, so the last one given wins.
+    Returns (stream, stream_raw).
+    """
+    mode = getattr(args, "stream_mode", None)
+    if mode is None:
+        return stream, False
+    return mode != "off", mode == "raw"
+
+
 def run_container(args: List[str], stream: bool = True, stream_raw: bool = False) -> int:
     """Run the container and return exit code."""
     runtime = claude_docker.runtime_cmd
 
     # Extract container name for cleanup
-    for i, arg in enumerate(args):
-        if arg == "--name" and i + 1 < len(args):
-            claude_docker._running_container = args[i + 1]
-            break
+    name = _container_name(args)
+    if name:
+        claude_docker._running_container = name
 
     cmd = runtime + args
 
     if stream and not stream_raw:
         try:
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=sys.stderr, env=os.environ)
-            # Find format-stream in PATH first (for tests), then SCRIPT_DIR
-            format_stream_path = shutil.which("format-stream")
-            if not format_stream_path:
-                # Fallback to SCRIPT_DIR
-                format_stream_path = SCRIPT_DIR / "format-stream"
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=sys.stderr)
             format_proc = subprocess.Popen(
-                [str(format_stream_path)] if isinstance(format_stream_path, Path) else format_stream_path,
+                [_format_stream_path()],
                 stdin=proc.stdout,
                 stdout=sys.stdout,
-                stderr=sys.stderr,
-                env=os.environ
+                stderr=sys.stderr
             )
             proc.stdout.close()
             format_proc.wait()
-            # Cleanup on normal exit
-            cleanup_container(runtime)
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                # Runtime client still attached (e.g. format-stream died): stop it
+                cleanup_container(runtime)
+            claude_docker.forget_container()
             return format_proc.returncode
         except Exception as e:
             print(f"Error running container: {e}", file=sys.stderr)
@@ -935,8 +1199,7 @@ def run_container(args: List[str], stream: bool = True, stream_raw: bool = False
     else:
         try:
             result = subprocess.run(cmd)
-            # Cleanup on normal exit
-            cleanup_container(runtime)
+            claude_docker.forget_container()
             return result.returncode
         except Exception as e:
             print(f"Error running container: {e}", file=sys.stderr)
@@ -944,6 +1207,65 @@ def run_container(args: List[str], stream: bool = True, stream_raw: bool = False
             return 1
 
 
+@functools.lru_cache(maxsize=1)
+def _format_stream_path() -> str:
+    """Locate format-stream once: PATH first (tests stub it there), then SCRIPT_DIR."""
+    return shutil.which("format-stream") or str(SCRIPT_DIR / "format-stream")
+
+
+def _container_name(args: List[str]) -> Optional[str]:
+    """Return the value of --name in container run args, if any."""
+    for i, arg in enumerate(args):
+        if arg == "--name" and i + 1 < len(args):
+            return args[i + 1]
+    return None
+
+
+def _exec_with_stop_trap(args: List[str], formatter: Optional[str] = None) -> int:
+    """Replace this process with the container run under /bin/sh; returns only on failure.
+
+    The shell takes over the signal handler's job: on SIGINT/SIGTERM it stops
+    the named container before exiting 130. Relying on the runtime client to
+    forward the signal is not enough, since entrypoint.sh runs as PID 1 with
+    no trap and so ignores it. With a formatter the output is piped through it.
+    """
+    runtime = claude_docker.runtime_cmd
+    lines = []
+    name = _container_name(args)
+    if name:
+        lines += [
+            f"stop_container() {{ {shlex.join(runtime + ['stop', name])} >/dev/null 2>&1; }}",
+            "trap 'stop_container; exit 130' INT TERM",
+        ]
+    run = shlex.join(runtime + args)
+    if formatter:
+        run += f" | {shlex.quote(formatter)}"
+    # Backgrounded so the trap runs as soon as a signal arrives; the exit
+    # status is the last command's, as with run_container.
+    lines += [f"{run} &", "wait $!"]
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        os.execv("/bin/sh", ["/bin/sh", "-c", "\n".join(lines)])
+    except OSError as e:
+        print(f"Error running container: {e}", file=sys.stderr)
+    return 1
+
+
+def exec_formatted_container(args: List[str]) -> int:
+    """Replace this process with `runtime ... | format-stream`; see _exec_with_stop_trap."""
+    return _exec_with_stop_trap(args, _format_stream_path())
+
+
+def exec_container(args: List[str]) -> int:
+    """Replace this process with the container runtime; see _exec_with_stop_trap.
+
+    For one-shot runs with no formatter. --rm removes the container once the
+    trap has stopped it.
+    """
+    return _exec_with_stop_trap(args)
+
+
 def build_docker_args(
     prompt: str,
     work_dir: str,
@@ -968,36 +1290,34 @@ def build_docker_args(
         "-v", f"{work_dir}:/workspace{':ro' if readonly else ''}",
     ]
 
-    if CREDENTIALS.exists():
-        mounts.extend(["-v", f"{CREDENTIALS}:/home/node/.claude/.credentials.json:ro"])
+    if _has_host_credentials():
+        mounts += _CREDENTIALS_MOUNT
 
-    mounts.extend(["-v", f"{DOCKER_YAML_CONFIG}:/home/node/claude-docker.yaml"])
+    mounts += _DOCKER_YAML_MOUNT
     effective_user_config = effective_config / ".claude.json"
     if effective_user_config.exists():
-        mounts.extend(["-v", f"{effective_user_config}:/home/node/.claude.json"])
+        mounts += ("-v", f"{effective_user_config}:/home/node/.claude.json")
 
-    if extra_volumes:
-        for vol in extra_volumes:
-            mounts.extend(["-v", vol])
+    for vol in extra_volumes or ():
+        mounts += ("-v", vol)
 
     env_args = ["-e", f"CLAUDE_PROJECT_NAME={project_name}"]
     if agent_mode:
-        env_args.extend(["-e", "CLAUDE_AGENT_MODE=1"])
+        env_args += ("-e", "CLAUDE_AGENT_MODE=1")
 
-    if os.environ.get("CLAUDE_CODE_OAUTH_TOKEN"):
-        env_args.extend(["-e", f"CLAUDE_CODE_OAUTH_TOKEN={os.environ['CLAUDE_CODE_OAUTH_TOKEN']}"])
-    elif TOKEN_FILE.exists():
-        env_args.extend(["-e", f"CLAUDE_CODE_OAUTH_TOKEN={TOKEN_FILE.read_text().strip()}"])
+    token = _oauth_token()
+    if token:
+        env_args += ("-e", f"CLAUDE_CODE_OAUTH_TOKEN={token}")
 
     if os.environ.get("C3PO_DEBUG"):
-        env_args.extend(["-e", f"C3PO_DEBUG={os.environ['C3PO_DEBUG']}"])
+        env_args += ("-e", f"C3PO_DEBUG={os.environ['C3PO_DEBUG']}")
 
     for key, value in agent_env.items():
-        env_args.extend(["-e", f"{key}={value}"])
+        env_args += ("-e", f"{key}={value}")
 
     if agent_init:
         init_b64 = encode_init_commands(agent_init)
-        env_args.extend(["-e", f"AGENT_INIT={init_b64}"])
+        env_args += ("-e", f"AGENT_INIT={init_b64}")
 
     if agent_mode:
         prompt = agent_prompt
@@ -1006,7 +1326,7 @@ def build_docker_args(
     if stream or stream_raw:
         claude_args = ["--output-format", "stream-json", "--verbose", "-p", prompt]
     if agent_model:
-        claude_args.extend(["--model", agent_model])
+        claude_args += ("--model", agent_model)
 
     container_name = f"claude-code-{os.getpid()}"
 
@@ -1021,6 +1341,42 @@ def build_docker_args(
     return docker_args, stream
 
 
+def _strip_ansi(text: str) -> str:
+    """Remove ANSI CSI sequences (ESC [ params final-byte) in a single pass.
+
+    The final byte is anything in 0x40-0x7E per ECMA-48. An unterminated
+    sequence at the end of the text is left as-is.
+    """
+    out = []
+    i = 0
+    n = len(text)
+    while i < n:
+        start = text.find("\x1b[", i)
+        if start < 0:
+            out.append(text[i:])
+            break
+        out.append(text[i:start])
+        end = start + 2
+        while end < n and not ("@" <= text[end] <= "~"):
+            end += 1
+        if end >= n:
+            out.append(text[start:])
+            break
+        i = end + 1
+    return "".join(out)
+
+
+def _extract_token(output: str) -> Optional[str]:
+    """Pull the OAuth token out of `claude setup-token` output.
+
+    Stripping is skipped when the output has no escape sequences, since it
+    would return the text unchanged.
+    """
+    clean = _strip_ansi(output) if "\x1b[" in output else output
+    m = _TOKEN_RE.search(clean) or _TOKEN_FALLBACK_RE.search(clean)
+    return m.group(1) if m else None
+
+
 def cmd_setup(args: argparse.Namespace) -> int:
     """Handle setup subcommand."""
     CONFIG_DIR.mkdir(parents=True, exist_ok=True)
@@ -1029,13 +1385,7 @@ def cmd_setup(args: argparse.Namespace) -> int:
 
     # Initialize DOCKER_YAML_CONFIG with default logging settings if it doesn't exist
     if not DOCKER_YAML_CONFIG.exists():
-        yaml_config = """streamLogging:
-  enabled: true
-  directory: {directory}
-  retentionDays: 30
-  maxFileSizeMB: 10
-""".format(directory=Path.home() / ".claude-docker" / "session-logs")
-        DOCKER_YAML_CONFIG.write_text(yaml_config)
+        DOCKER_YAML_CONFIG.write_bytes(_DEFAULT_DOCKER_YAML)
         DOCKER_YAML_CONFIG.chmod(0o600)
 
     if args.token:
@@ -1045,6 +1395,7 @@ def cmd_setup(args: argparse.Namespace) -> int:
             return 1
         TOKEN_FILE.write_text(token + "\n")
         TOKEN_FILE.chmod(0o600)
+        _token_file_content.cache_clear()
         print(f"Token saved to {TOKEN_FILE}", file=sys.stderr)
         return 0
 
@@ -1054,20 +1405,17 @@ def cmd_setup(args: argparse.Namespace) -> int:
         print("Error: claude setup-token failed", file=sys.stderr)
         return 1
 
-    import re
-    clean = re.sub(r'\x1b\[[^a-zA-Z]*[a-zA-Z]', '', result.stdout)
-    m = re.search(r'(sk-ant-[a-zA-Z0-9_-]+|sk-at-[a-zA-Z0-9_-]+)(?=\s|[.,!]|$)', clean)
-    if not m:
-        m = re.search(r'(sk-ant-[a-zA-Z0-9_-]{90,110}|sk-at-[a-zA-Z0-9_-]{90,110})', clean)
+    token = _extract_token(result.stdout)
 
-    if not m:
+    if not token:
         print("Error: Could not extract token from claude setup-token output.", file=sys.stderr)
         print("\nPlease provide the token manually:", file=sys.stderr)
         print("  claude-docker setup <your-token>", file=sys.stderr)
         return 1
 
-    TOKEN_FILE.write_text(m.group(1) + "\n")
+    TOKEN_FILE.write_text(token + "\n")
     TOKEN_FILE.chmod(0o600)
+    _token_file_content.cache_clear()
     print(f"Token saved to {TOKEN_FILE}", file=sys.stderr)
     return 0
 
@@ -1083,8 +1431,6 @@ def cmd_rebuild(args: argparse.Namespace) -> int:
 
 def cmd_clean_logs(args: argparse.Namespace) -> int:
     """Handle clean-logs subcommand."""
-    import shutil
-
     # Show usage if running without arguments
     if not args.older_than:
         print("Usage: claude-docker clean-logs [--older-than DAYS]", file=sys.stderr)
@@ -1098,7 +1444,7 @@ def cmd_clean_logs(args: argparse.Namespace) -> int:
         if DOCKER_YAML_CONFIG.exists():
             import yaml
             with open(DOCKER_YAML_CONFIG) as f:
-                config = yaml.safe_load(f) or {}
+                config = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)) or {}
                 stream_log_config = config.get("streamLogging", {})
                 retention_days = stream_log_config.get("retentionDays", 30)
             log_dir = Path(stream_log_config.get("directory", str(Path.home() / ".claude-docker" / "session-logs"))).expanduser()
@@ -1118,23 +1464,25 @@ def cmd_clean_logs(args: argparse.Namespace) -> int:
             return 1
 
     # Calculate cutoff timestamp
-    cutoff = datetime.now() - timedelta(days=retention_days)
+    cutoff = (datetime.now() - timedelta(days=retention_days)).timestamp()
 
-    # Delete old log files
+    # Delete old log files (one stat per entry, reused for mtime and size)
     deleted_count = 0
     total_size = 0
 
     if log_dir.exists():
-        for log_file in log_dir.glob("*.json"):
-            try:
-                file_mtime = datetime.fromtimestamp(log_file.stat().st_mtime)
-                if file_mtime < cutoff:
-                    file_size = log_file.stat().st_size
-                    log_file.unlink()
-                    deleted_count += 1
-                    total_size += file_size
-            except Exception as e:
-                print(f"Error deleting {log_file}: {e}", file=sys.stderr)
+        with os.scandir(log_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    st = entry.stat()
+                    if st.st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        deleted_count += 1
+                        total_size += st.st_size
+                except Exception as e:
+                    print(f"Error deleting {entry.path}: {e}", file=sys.stderr)
 
     # Print summary
     print(f"Cleaned up {deleted_count} log file(s)", file=sys.stderr)
@@ -1145,6 +1493,34 @@ def cmd_clean_logs(args: argparse.Namespace) -> int:
     return 0
 
 
+# Enrolls the container's c3po plugin and stamps the machine name into its
+# credentials. url, token and machine name arrive as positional args ($1..$3)
+# rather than being interpolated into the script text.
+_C3PO_SETUP_SCRIPT = "\n".join([
+    "set -euo pipefail",
+    "echo 'Adding/updating michaelansel marketplace...'",
+    "claude plugin marketplace update michaelansel 2>/dev/null || claude plugin marketplace add michaelansel/claude-code-plugins",
+    "echo 'Installing/updating c3po plugin...'",
+    "claude plugin update c3po@michaelansel 2>/dev/null || claude plugin install c3po@michaelansel",
+    "echo 'Enrolling with coordinator...'",
+    "SETUP_PY=$(find ~/.claude/plugins -path '*/c3po*/setup.py' -print -quit)",
+    "if [[ -z \"$SETUP_PY\" ]]; then",
+    "    echo 'Error: Could not find c3po setup.py' >&2",
+    "    exit 1",
+    "fi",
+    'python3 "$SETUP_PY" --enroll "$1" "$2" --machine "$3" --pattern "$3/*"',
+    "echo 'Done! c3po plugin installed and enrolled.'"
+]) + """
+python3 -c "
+import json, pathlib, sys
+p = pathlib.Path.home() / '.claude' / 'c3po-credentials.json'
+d = json.loads(p.read_text())
+d['machine_name'] = sys.argv[1]
+p.write_text(json.dumps(d, indent=2) + '\\n')
+" "$3"
+"""
+
+
 def cmd_setup_c3po(args: argparse.Namespace) -> int:
     """Handle setup-c3po subcommand."""
     if not args.url or not args.token:
@@ -1165,46 +1541,17 @@ def cmd_setup_c3po(args: argparse.Namespace) -> int:
         print(f"Building {IMAGE_NAME} image...", file=sys.stderr)
         build_image(runtime, no_cache=cli_update)
 
-    machine_name = subprocess.run(["hostname"], capture_output=True, text=True).stdout.strip()
-
-    # Build setup script with proper escaping - use subprocess instead of f-strings for security
-    setup_commands = [
-        "set -euo pipefail",
-        "echo 'Adding/updating michaelansel marketplace...'",
-        "claude plugin marketplace update michaelansel 2>/dev/null || claude plugin marketplace add michaelansel/claude-code-plugins",
-        "echo 'Installing/updating c3po plugin...'",
-        "claude plugin update c3po@michaelansel 2>/dev/null || claude plugin install c3po@michaelansel",
-        "echo 'Enrolling with coordinator...'",
-        "SETUP_PY=$(find ~/.claude/plugins -path '*/c3po*/setup.py' -print -quit)",
-        "if [[ -z \"$SETUP_PY\" ]]; then",
-        "    echo 'Error: Could not find c3po setup.py' >&2",
-        "    exit 1",
-        "fi",
-        f"python3 \"$SETUP_PY\" --enroll {args.url} {args.token} --machine {machine_name} --pattern {machine_name}/*",
-        "echo 'Done! c3po plugin installed and enrolled.'"
-    ]
-
-    setup_script = "\n".join(setup_commands)
-
-    # Update c3po credentials
-    cred_script = f"""
-python3 -c "
-import json, pathlib
-p = pathlib.Path.home() / '.claude' / 'c3po-credentials.json'
-d = json.loads(p.read_text())
-d['machine_name'] = '{machine_name}'
-p.write_text(json.dumps(d, indent=2) + '\\n')
-"
-"""
+    import socket
+    machine_name = socket.gethostname()
 
     subprocess.run([
         *runtime, "run", "--rm", "-it",
         "--entrypoint", "bash",
-        "-v", f"{SHARED_DIR}:/home/node/.claude",
-        "-v", f"{DOCKER_YAML_CONFIG}:/home/node/claude-docker.yaml",
-        "-v", f"{USER_CONFIG}:/home/node/.claude.json",
+        *_SHARED_DIR_MOUNT,
+        *_DOCKER_YAML_MOUNT,
+        *_USER_CONFIG_MOUNT,
         IMAGE_NAME,
-        "-c", setup_script + cred_script
+        "-c", _C3PO_SETUP_SCRIPT, "_", args.url, args.token, machine_name
     ], check=True)
 
     # Move credentials from shared/ to canonical CONFIG_DIR root
@@ -1238,20 +1585,19 @@ def cmd_shell(args: argparse.Namespace) -> int:
     shell_claude_json = host_claude_json if host_claude_json.exists() else USER_CONFIG
 
     shell_mounts = [
-        "-v", f"{SHARED_DIR}:/home/node/.claude",
+        *_SHARED_DIR_MOUNT,
         "-v", f"{os.getcwd()}:/workspace",
-        "-v", f"{DOCKER_YAML_CONFIG}:/home/node/claude-docker.yaml",
+        *_DOCKER_YAML_MOUNT,
         "-v", f"{shell_claude_json}:/home/node/.claude.json",
     ]
 
-    if CREDENTIALS.exists():
-        shell_mounts.extend(["-v", f"{CREDENTIALS}:/home/node/.claude/.credentials.json:ro"])
+    if _has_host_credentials():
+        shell_mounts.extend(_CREDENTIALS_MOUNT)
 
     shell_env = []
-    if os.environ.get("CLAUDE_CODE_OAUTH_TOKEN"):
-        shell_env.extend(["-e", f"CLAUDE_CODE_OAUTH_TOKEN={os.environ['CLAUDE_CODE_OAUTH_TOKEN']}"])
-    elif TOKEN_FILE.exists():
-        shell_env.extend(["-e", f"CLAUDE_CODE_OAUTH_TOKEN={TOKEN_FILE.read_text().strip()}"])
+    token = _oauth_token()
+    if token:
+        shell_env.extend(["-e", f"CLAUDE_CODE_OAUTH_TOKEN={token}"])
 
     # Pass C3PO_MACHINE_NAME explicitly so the hook doesn't fall back to reading ~/.claude.json,
     # which may have a different machine name (e.g. host vs docker).
@@ -1315,42 +1661,19 @@ def cmd_agent_run(args: argparse.Namespace) -> int:
         print(f"Error: agent '{agent_name}' has no workspace configured", file=sys.stderr)
         return 1
 
-    # Parse args for global flags (stream settings)
-    global_flags = []
-    for arg in sys.argv[1:]:
-        if arg in ("-s", "-sj", "--no-stream", "-b", "--log-stream", "--no-log-stream", "--log-dir"):
-            global_flags.append(arg)
-
     project_name = agent_name
     runtime = claude_docker.runtime_cmd
 
     # Check if -b flag forces a rebuild
-    force_rebuild = "-b" in global_flags
+    force_rebuild = getattr(args, "build", False)
     cli_update = needs_cli_update()
 
     if force_rebuild or needs_rebuild(runtime) or cli_update:
         print(f"Building {IMAGE_NAME} image...", file=sys.stderr)
         build_image(runtime, no_cache=not force_rebuild and cli_update)
 
-    # Parse global_flags for stream settings
-    agent_stream = True  # Default for agent mode
-    agent_stream_raw = False
-    i = 0
-    while i < len(global_flags):
-        flag = global_flags[i]
-        if flag == "--no-stream":
-            agent_stream = False
-            agent_stream_raw = False
-            i += 1
-        elif flag == "-s":
-            agent_stream = True
-            i += 1
-        elif flag == "-sj":
-            agent_stream = True
-            agent_stream_raw = True
-            i += 1
-        else:
-            i += 1
+    # Agent mode streams by default
+    agent_stream, agent_stream_raw = _stream_settings(args, stream=True)
 
     # Determine prompt: CLI flag > config > default (None = /c3po auto)
     agent_prompt = getattr(args, 'prompt', None) or config.prompt
@@ -1396,14 +1719,7 @@ def cmd_agent_run(args: argparse.Namespace) -> int:
 
 def cmd_direct_prompt(prompt: str, args: argparse.Namespace, flags: List[str]) -> int:
     """Handle direct prompt (non-agent) mode."""
-    import sys
-    if os.environ.get("CLAUDE_CODE_OAUTH_TOKEN"):
-        pass
-    elif TOKEN_FILE.exists():
-        os.environ["CLAUDE_CODE_OAUTH_TOKEN"] = TOKEN_FILE.read_text().strip()
-    elif CREDENTIALS.exists():
-        pass
-    else:
+    if not _oauth_token() and not _has_host_credentials():
         print("Error: No Claude Code authentication found.", file=sys.stderr)
         print("", file=sys.stderr)
         print("Run setup to generate and store a token:", file=sys.stderr)
@@ -1422,13 +1738,7 @@ def cmd_direct_prompt(prompt: str, args: argparse.Namespace, flags: List[str]) -
 
     # Initialize DOCKER_YAML_CONFIG with default logging settings if it doesn't exist
     if not DOCKER_YAML_CONFIG.exists():
-        yaml_config = """streamLogging:
-  enabled: true
-  directory: {directory}
-  retentionDays: 30
-  maxFileSizeMB: 10
-""".format(directory=Path.home() / ".claude-docker" / "session-logs")
-        DOCKER_YAML_CONFIG.write_text(yaml_config)
+        DOCKER_YAML_CONFIG.write_bytes(_DEFAULT_DOCKER_YAML)
         DOCKER_YAML_CONFIG.chmod(0o600)
 
     container_claude_md = SCRIPT_DIR / "container-CLAUDE.md"
@@ -1438,7 +1748,7 @@ def cmd_direct_prompt(prompt: str, args: argparse.Namespace, flags: List[str]) -
     runtime = claude_docker.runtime_cmd
 
     # Check if -b flag forces a rebuild
-    force_rebuild = "-b" in flags
+    force_rebuild = getattr(args, "build", False)
 
     try:
         cli_update = needs_cli_update()
@@ -1455,8 +1765,6 @@ def cmd_direct_prompt(prompt: str, args: argparse.Namespace, flags: List[str]) -
 
     # Parse flags for options
     work_dir = None
-    stream = True  # Default
-    stream_raw = False
     readonly = False
     i = 0
     while i < len(flags):
@@ -1470,26 +1778,14 @@ def cmd_direct_prompt(prompt: str, args: argparse.Namespace, flags: List[str]) -
         elif flag.startswith("-d="):
             work_dir = flag[3:]
             i += 1
-        elif flag == "-s":
-            stream = True
-            i += 1
-        elif flag == "-sj":
-            stream = True
-            stream_raw = True
-            i += 1
-        elif flag == "--no-stream":
-            stream = False
-            stream_raw = False
-            i += 1
         elif flag == "--readonly":
             readonly = True
             i += 1
-        elif flag == "-b":
-            i += 1
-            continue
         else:
             i += 1
 
+    stream, stream_raw = _stream_settings(args, stream=True)
+
     if work_dir is None:
         work_dir = os.getcwd()
 
@@ -1508,7 +1804,153 @@ def cmd_direct_prompt(prompt: str, args: argparse.Namespace, flags: List[str]) -
         readonly=readonly,
     )
 
-    return run_container(docker_args, stream=stream, stream_raw=stream_raw)
+    # Nothing follows the run in direct mode, so hand the process over
+    if not stream or stream_raw:
+        return exec_container(docker_args)
+    return exec_formatted_container(docker_args)
+
+
+COMMANDS = {
+    "setup": cmd_setup,
+    "setup-c3po": cmd_setup_c3po,
+    "shell": cmd_shell,
+    "rebuild": cmd_rebuild,
+    "clean-logs": cmd_clean_logs,
+}
+
+AGENT_COMMANDS = {
+    "list": cmd_agent_list,
+    "run": cmd_agent_run,
+}
+
+# Top-level flags forwarded to cmd_direct_prompt; _VALUE_FLAGS also take the next arg
+_DIRECT_PROMPT_FLAGS = frozenset({
+    "-s", "-sj", "--stream", "--stream-json", "--no-stream", "-b", "--build",
+    "--log-stream", "--no-log-stream", "--log-dir", "-d", "--dir", "--readonly",
+})
+_VALUE_FLAGS = frozenset({"-d", "--dir", "--log-dir"})
+
+
+def _direct_prompt_flags(argv: List[str]) -> List[str]:
+    """Collect the top-level flags (with their values) that cmd_direct_prompt reads."""
+    flags = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in _DIRECT_PROMPT_FLAGS:
+            flags.append(arg)
+            if arg in _VALUE_FLAGS and i + 1 < len(argv):
+                flags.append(argv[i + 1])
+                i += 1
+        elif arg.startswith(("--dir=", "-d=")):
+            flags.append(arg)
+        i += 1
+    return flags
+
+
+def _add_setup_parser(subparsers) -> argparse.ArgumentParser:
+    """Add the `setup [token]` subparser."""
+    setup_parser = subparsers.add_parser("setup", help="Set up authentication")
+    setup_parser.add_argument("token", nargs="?", help="OAuth token")
+    return setup_parser
+
+
+def _add_setup_c3po_parser(subparsers) -> argparse.ArgumentParser:
+    """Add the `setup-c3po <url> <token>` subparser."""
+    setup_c3po_parser = subparsers.add_parser("setup-c3po",
+        help="Install and enroll c3po plugin")
+    setup_c3po_parser.add_argument("url", nargs="?", help="Coordinator URL")
+    setup_c3po_parser.add_argument("token", nargs="?", help="Admin token")
+    return setup_c3po_parser
+
+
+def _add_shell_parser(subparsers) -> argparse.ArgumentParser:
+    """Add the `shell` subparser."""
+    return subparsers.add_parser("shell", help="Interactive shell in container")
+
+
+def _add_rebuild_parser(subparsers) -> argparse.ArgumentParser:
+    """Add the `rebuild` subparser."""
+    return subparsers.add_parser("rebuild", help="Rebuild image with no cache to get latest Claude CLI")
+
+
+def _add_clean_logs_parser(subparsers) -> argparse.ArgumentParser:
+    """Add the `clean-logs [--older-than DAYS]` subparser."""
+    clean_logs_parser = subparsers.add_parser("clean-logs", help="Clean up old session logs")
+    clean_logs_parser.add_argument("--older-than", help="Delete logs older than X days (e.g., 7d, 30d)")
+    return clean_logs_parser
+
+
+def _add_agent_parser(subparsers) -> argparse.ArgumentParser:
+    """Add the `agent list | agent run <name>` subparser."""
+    agent_parser = subparsers.add_parser("agent",
+        help="Run named agent",
+        description="Manage agents: agent list or agent run <name>")
+    # Add global flags to agent parser so they're recognized. SUPPRESS keeps
+    # unset ones from overwriting values given before 'agent'.
+    agent_parser.add_argument("-s", "--stream", dest="stream_mode", action="store_const",
+                        const="formatted", default=argparse.SUPPRESS, help="Stream formatted output")
+    agent_parser.add_argument("-sj", "--stream-json", dest="stream_mode", action="store_const",
+                        const="raw", default=argparse.SUPPRESS, help="Stream raw JSON output")
+    agent_parser.add_argument("--no-stream", dest="stream_mode", action="store_const",
+                        const="off", default=argparse.SUPPRESS, help="Disable streaming")
+    agent_parser.add_argument("-b", "--build", action="store_true", default=argparse.SUPPRESS,
+                        help="Rebuild image before running")
+    agent_parser.add_argument("--log-stream", action="store_true", default=argparse.SUPPRESS,
+                        help="Enable session logging")
+    agent_parser.add_argument("--no-log-stream", action="store_true", default=argparse.SUPPRESS,
+                        help="Disable session logging")
+    agent_parser.add_argument("--log-dir", default=argparse.SUPPRESS, help="Override log directory")
+
+    agent_subparsers = agent_parser.add_subparsers(dest="agent_cmd", help="Agent command (list or run <name>)")
+    agent_subparsers.add_parser("list", help="List available agents")
+    agent_run_parser = agent_subparsers.add_parser("run", help="Run named agent")
+    agent_run_parser.add_argument("agent_name", help="Agent name")
+    agent_run_parser.add_argument("-e", "--env", action="append", dest="env_vars",
+                                  help="Environment variable (KEY=VALUE, can be used multiple times)")
+    agent_run_parser.add_argument("--prompt", help="Custom prompt to override default /c3po auto")
+    agent_run_parser.add_argument("--once", action="store_true",
+                                  help="Run container once even if triggers are configured (skips loop)")
+    return agent_parser
+
+
+# Subparser builders in help order; main() only builds the ones argv can reach
+SUBCMD_BUILDERS = {
+    "setup": _add_setup_parser,
+    "setup-c3po": _add_setup_c3po_parser,
+    "shell": _add_shell_parser,
+    "rebuild": _add_rebuild_parser,
+    "clean-logs": _add_clean_logs_parser,
+    "agent": _add_agent_parser,
+}
+
+# Top-level flags as main() declares them; _TOP_VALUE_FLAGS take the next arg
+_TOP_FLAGS = frozenset({
+    "-s", "--stream", "-sj", "--stream-json", "--no-stream", "-b", "--build",
+    "--log-stream", "--no-log-stream", "--readonly",
+})
+_TOP_VALUE_FLAGS = frozenset({"-d", "--dir", "--log-dir", "-p", "--prompt"})
+
+
+def _subcommands_to_build(argv: List[str]) -> List[str]:
+    """Pick the subparsers main() needs for argv.
+
+    That is just the named subcommand, or none for a plain `-p` run. Help, an
+    unrecognized flag before the command, or an unknown command builds all of
+    them so argparse can parse and report exactly as before.
+    """
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if not arg.startswith("-"):
+            return [arg] if arg in SUBCMD_BUILDERS else list(SUBCMD_BUILDERS)
+        if arg in _TOP_VALUE_FLAGS:
+            i += 2
+            continue
+        if arg not in _TOP_FLAGS and not arg.startswith(("--dir=", "--log-dir=", "--prompt=")):
+            return list(SUBCMD_BUILDERS)  # -h/--help, abbreviations, typos
+        i += 1
+    return []
 
 
 class CustomFormatter(argparse.RawDescriptionHelpFormatter):
@@ -1521,16 +1963,15 @@ class CustomFormatter(argparse.RawDescriptionHelpFormatter):
         return super()._format_usage(usage, actions, groups, prefix)
 
 
-def print_help():
-    """Print help message with Usage: (uppercase) header."""
-    help_text = """Usage:
+_STATIC_HELP = """Usage:
   claude-docker -p <prompt>        Run a prompt
   claude-docker -d <path> -p <prompt>  Run with specific working directory
-  claude-docker setup              Set up authentication
+  claude-docker setup [token]      Set up authentication
   claude-docker setup-c3po <url> <token>  Install and enroll c3po plugin
   claude-docker shell              Interactive shell in container
+  claude-docker rebuild            Rebuild image with no cache to get latest Claude CLI
   claude-docker agent list         List available agents
-  claude-docker agent <name>       Run named agent
+  claude-docker agent run <name>   Run named agent
   claude-docker clean-logs         Clean up old session logs
 
 Options:
@@ -1541,6 +1982,7 @@ Options:
   --no-stream      Disable streaming
   -b, --build      Rebuild image before running
   -p, --prompt PROMPT  Prompt to run
+  --readonly       Mount workspace read-only (direct mode)
 
   --log-stream      Enable session logging (default: enabled)
   --no-log-stream   Disable session logging
@@ -1548,18 +1990,30 @@ Options:
 
 Examples:
   claude-docker -p "hello world"   Run a prompt
-  claude-docker -d /path agent notes   Run agent with specific directory
-  claude-docker agent <name>       Run named agent
+  claude-docker -d /path agent run notes  Run agent with specific directory
+  claude-docker agent run <name>   Run named agent
   claude-docker agent list         List available agents
   claude-docker setup              Set up authentication
   claude-docker shell              Interactive shell
   claude-docker clean-logs         Clean up old session logs
+
+Run 'claude-docker <command> -h' for command-specific options.
 """
-    print(help_text)
 
 
-def main():
-    """Main entry point with argparse-based argument parsing."""
+def print_help():
+    """Print the top-level help without building the argparse tree."""
+    print(_STATIC_HELP)
+
+
+@functools.lru_cache(maxsize=None)
+def _build_parser(
+    subcommands: Tuple[str, ...],
+) -> Tuple[argparse.ArgumentParser, Dict[str, argparse.ArgumentParser]]:
+    """Build the CLI parser with the named subparsers; returns (parser, subparsers by name).
+
+    Cached, since argparse parsers can be reused across parse_args() calls.
+    """
     parser = argparse.ArgumentParser(
         prog="claude-docker",
         description="Run Claude Code inside Docker/Finch containers",
@@ -1580,12 +2034,12 @@ Examples:
 
     # Global flags
     parser.add_argument("-d", "--dir", help="Working directory to mount")
-    parser.add_argument("-s", "--stream", action="store_true",
-                        help="Stream formatted output")
-    parser.add_argument("-sj", "--stream-json", action="store_true",
-                        help="Stream raw JSON output")
-    parser.add_argument("--no-stream", action="store_true",
-                        help="Disable streaming")
+    parser.add_argument("-s", "--stream", dest="stream_mode", action="store_const",
+                        const="formatted", help="Stream formatted output")
+    parser.add_argument("-sj", "--stream-json", dest="stream_mode", action="store_const",
+                        const="raw", help="Stream raw JSON output")
+    parser.add_argument("--no-stream", dest="stream_mode", action="store_const",
+                        const="off", help="Disable streaming")
     parser.add_argument("-b", "--build", action="store_true",
                         help="Rebuild image before running")
     parser.add_argument("--log-stream", action="store_true",
@@ -1599,102 +2053,41 @@ Examples:
 
     # Subcommands
     subparsers = parser.add_subparsers(dest="command", help="Subcommands")
+    built = {name: SUBCMD_BUILDERS[name](subparsers) for name in subcommands}
+    return parser, built
 
-    # setup
-    setup_parser = subparsers.add_parser("setup", help="Set up authentication")
-    setup_parser.add_argument("token", nargs="?", help="OAuth token")
 
-    # setup-c3po
-    setup_c3po_parser = subparsers.add_parser("setup-c3po",
-        help="Install and enroll c3po plugin")
-    setup_c3po_parser.add_argument("url", nargs="?", help="Coordinator URL")
-    setup_c3po_parser.add_argument("token", nargs="?", help="Admin token")
-
-    # shell
-    subparsers.add_parser("shell", help="Interactive shell in container")
-
-    # rebuild
-    subparsers.add_parser("rebuild", help="Rebuild image with no cache to get latest Claude CLI")
-
-    # clean-logs
-    clean_logs_parser = subparsers.add_parser("clean-logs", help="Clean up old session logs")
-    clean_logs_parser.add_argument("--older-than", help="Delete logs older than X days (e.g., 7d, 30d)")
-
-    # agent
-    agent_parser = subparsers.add_parser("agent",
-        help="Run named agent",
-        description="Manage agents: agent list or agent run <name>")
-    # Add global flags to agent parser so they're recognized
-    agent_parser.add_argument("-s", "--stream", action="store_true",
-                        help="Stream formatted output")
-    agent_parser.add_argument("-sj", "--stream-json", action="store_true",
-                        help="Stream raw JSON output")
-    agent_parser.add_argument("--no-stream", action="store_true",
-                        help="Disable streaming")
-    agent_parser.add_argument("-b", "--build", action="store_true",
-                        help="Rebuild image before running")
-    agent_parser.add_argument("--log-stream", action="store_true",
-                        help="Enable session logging")
-    agent_parser.add_argument("--no-log-stream", action="store_true",
-                        help="Disable session logging")
-    agent_parser.add_argument("--log-dir", help="Override log directory")
-
-    agent_subparsers = agent_parser.add_subparsers(dest="agent_cmd", help="Agent command (list or run <name>)")
-    agent_subparsers.add_parser("list", help="List available agents")
-    agent_run_parser = agent_subparsers.add_parser("run", help="Run named agent")
-    agent_run_parser.add_argument("agent_name", help="Agent name")
-    agent_run_parser.add_argument("-e", "--env", action="append", dest="env_vars",
-                                  help="Environment variable (KEY=VALUE, can be used multiple times)")
-    agent_run_parser.add_argument("--prompt", help="Custom prompt to override default /c3po auto")
-    agent_run_parser.add_argument("--once", action="store_true",
-                                  help="Run container once even if triggers are configured (skips loop)")
+def main():
+    """Main entry point with argparse-based argument parsing."""
+    # Bare invocation and a lone -h/--help never need the argparse tree
+    argv = sys.argv[1:]
+    if not argv:
+        print_help()
+        sys.exit(2)
+    if argv in (["-h"], ["--help"]):
+        print_help()
+        sys.exit(0)
 
+    # Only the subparsers this command line can reach are built
+    parser, built = _build_parser(tuple(_subcommands_to_build(argv)))
     args = parser.parse_args()
 
     # Determine mode and dispatch
-    if args.command == "setup":
-        sys.exit(cmd_setup(args))
-    elif args.command == "setup-c3po":
-        sys.exit(cmd_setup_c3po(args))
-    elif args.command == "shell":
-        sys.exit(cmd_shell(args))
-    elif args.command == "rebuild":
-        sys.exit(cmd_rebuild(args))
-    elif args.command == "clean-logs":
-        sys.exit(cmd_clean_logs(args))
-    elif args.command == "agent":
-        if args.agent_cmd == "list":
-            sys.exit(cmd_agent_list(args))
-        elif args.agent_cmd == "run":
-            sys.exit(cmd_agent_run(args))
-        else:
-            agent_parser.print_help()
-            sys.exit(2)
-    elif args.command is None:
-        if args.prompt:
-            # Direct prompt mode with -p flag
-            global_flags = []
-            i = 0
-            while i < len(sys.argv[1:]):
-                arg = sys.argv[i + 1]
-                if arg in ("-s", "-sj", "--stream", "--stream-json", "--no-stream", "-b", "--build",
-                           "--log-stream", "--no-log-stream", "--log-dir", "-d", "--dir", "--readonly"):
-                    global_flags.append(arg)
-                    if arg in ("-d", "--dir", "--log-dir") and i + 1 < len(sys.argv[1:]):
-                        global_flags.append(sys.argv[i + 2])
-                        i += 1
-                elif arg.startswith("--dir=") or arg.startswith("-d="):
-                    global_flags.append(arg)
-                i += 1
-            sys.exit(cmd_direct_prompt(args.prompt, args, global_flags))
-        else:
-            # No subcommand and no prompt - show help
-            parser.print_help()
+    if args.command in COMMANDS:
+        sys.exit(COMMANDS[args.command](args))
+    if args.command == "agent":
+        handler = AGENT_COMMANDS.get(args.agent_cmd)
+        if handler is None:
+            built["agent"].print_help()
             sys.exit(2)
-    else:
-        # Unknown command
-        parser.print_help()
-        sys.exit(2)
+        sys.exit(handler(args))
+    if args.command is None and args.prompt:
+        # Direct prompt mode with -p flag
+        sys.exit(cmd_direct_prompt(args.prompt, args, _direct_prompt_flags(argv)))
+
+    # No subcommand and no prompt - show help
+    print_help()
+    sys.exit(2)
 
 
 if __name__ == "__main__":
@@ -6,16 +6,28 @@ from unittest.mock import MagicMock
 
 
 @pytest.fixture(autouse=True)
-def mock_container_ops(monkeypatch):
+def mock_container_ops(monkeypatch, tmp_path):
     """Mock container/subprocess operations so tests run without real containers."""
     import claude_docker as cd
 
+    # Don't let per-process lookups from one test leak into the next
+    cd._token_file_content.cache_clear()
+    cd._has_host_credentials.cache_clear()
+    cd._format_stream_path.cache_clear()
+
+    # Keep the on-disk caches out of the real config dir
+    monkeypatch.setattr(cd, 'AGENTS_CACHE_FILE', tmp_path / '.agents-cache.json')
+    monkeypatch.setattr(cd, 'RUNTIME_CACHE_FILE', tmp_path / '.runtime')
+    monkeypatch.setattr(cd, 'BUILD_HASH_CACHE_FILE', tmp_path / '.build-hash-cache')
+
     # Pre-set runtime so subprocess detection calls are skipped
     monkeypatch.setattr(cd.claude_docker, '_runtime', 'docker')
     monkeypatch.setattr(cd.claude_docker, '_needs_sudo', False)
 
     # Mock heavy container operations
     monkeypatch.setattr(cd, 'run_container', lambda *a, **kw: 0)
+    monkeypatch.setattr(cd, 'exec_container', lambda *a, **kw: 0)
+    monkeypatch.setattr(cd, 'exec_formatted_container', lambda *a, **kw: 0)
     monkeypatch.setattr(cd, 'needs_rebuild', lambda *a, **kw: False)
     monkeypatch.setattr(cd, 'needs_cli_update', lambda: False)
     monkeypatch.setattr(cd, 'build_image', lambda *a, **kw: None)
@@ -1,5 +1,7 @@
 """Test AgentConfig dataclass."""
 
+import sys
+import dataclasses
 import pytest
 from dataclasses import FrozenInstanceError
 from claude_docker import AgentConfig
@@ -29,7 +31,7 @@ def test_agent_config_default_values():
     )
     assert config.model is None
     assert config.env == {}
-    assert config.init == []
+    assert config.init == ()
 
 
 def test_agent_config_frozen():
@@ -70,6 +72,32 @@ def test_agent_config_inequality():
     assert config1 != config2
 
 
+FIELD_CHANGES = {
+    "name": "other",
+    "workspace": "/tmp/other",
+    "model": "opus",
+    "env": {"VAR": "value"},
+    "init": ("cmd",),
+    "prompt": "Do stuff.",
+    "triggers": ({"type": "c3po"},),
+    "post_run": ("cmd",),
+    "wait_first": True,
+    "readonly": True,
+}
+
+
+@pytest.mark.parametrize("field_name,value", FIELD_CHANGES.items())
+def test_agent_config_inequality_per_field(field_name, value):
+    """Test that a difference in any single field makes configs unequal."""
+    base = AgentConfig(name="test", workspace="/tmp/test")
+    assert base != dataclasses.replace(base, **{field_name: value})
+
+
+def test_agent_config_equality_covers_all_fields():
+    """Test that the hand-written __eq__ cases track every AgentConfig field."""
+    assert set(FIELD_CHANGES) == {f.name for f in dataclasses.fields(AgentConfig)}
+
+
 def test_agent_config_repr():
     """Test AgentConfig string representation."""
     config = AgentConfig(
@@ -88,8 +116,8 @@ def test_agent_config_triggers_default():
         name="notes",
         workspace="/home/user/notes"
     )
-    assert config.triggers == []
-    assert config.post_run == []
+    assert config.triggers == ()
+    assert config.post_run == ()
 
 
 def test_agent_config_readonly_default():
@@ -163,3 +191,19 @@ def test_agent_config_with_mixed_triggers():
     assert len(config.triggers) == 2
     assert config.triggers[0]["type"] == "schedule"
     assert config.triggers[1]["type"] == "c3po"
+
+
+@pytest.mark.skipif(sys.version_info < (3, 10), reason="dataclass slots need Python 3.10+")
+def test_agent_config_slots():
+    """Test that AgentConfig instances carry no per-instance __dict__."""
+    config = AgentConfig(name="test", workspace="/tmp/test")
+    assert not hasattr(config, "__dict__")
+
+
+def test_agent_config_defaults_shared():
+    """Test that empty defaults are shared read-only singletons."""
+    a = AgentConfig(name="a", workspace="/tmp/a")
+    b = AgentConfig(name="b", workspace="/tmp/b")
+    assert a.env is b.env
+    with pytest.raises(TypeError):
+        a.env["KEY"] = "value"
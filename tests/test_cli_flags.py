@@ -7,126 +7,192 @@ from claude_docker import main
 import sys
 
 
-def test_help_flag():
+def test_help_flag(monkeypatch):
     """Test -h/--help flag."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "-h"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "-h"])
         main()
     assert exc_info.value.code == 0
 
 
-def test_no_args_shows_usage():
+def test_no_args_shows_usage(monkeypatch):
     """Test that no arguments shows usage."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker"])
         main()
     assert exc_info.value.code == 2
 
 
-def test_direct_prompt_with_p_flag():
+@pytest.mark.parametrize("argv", [[], ["-h"], ["--help"]])
+def test_help_skips_parser(monkeypatch, capsys, argv):
+    """Bare invocation and a lone -h print the static help without argparse."""
+    import claude_docker
+    monkeypatch.setattr(claude_docker, "_build_parser", None)
+    monkeypatch.setattr(sys, "argv", ["claude-docker"] + argv)
+    with pytest.raises(SystemExit):
+        main()
+    assert "agent run <name>" in capsys.readouterr().out
+
+
+def test_direct_prompt_with_p_flag(monkeypatch):
     """Test direct prompt with -p flag."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "-p", "hello world"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "-p", "hello world"])
         main()
     assert exc_info.value.code == 0
 
 
-def test_direct_prompt_positional():
+def test_direct_prompt_positional(monkeypatch):
     """Test direct prompt with positional args (uses -p flag)."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "-p", "hello world"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "-p", "hello world"])
         main()
     assert exc_info.value.code == 0
 
 
-def test_agent_list():
+def test_agent_list(monkeypatch):
     """Test agent list subcommand."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "agent", "list"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "agent", "list"])
         main()
     assert exc_info.value.code == 0
 
 
-def test_agent_run():
+def test_agent_run(monkeypatch):
     """Test agent run subcommand."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "agent", "run", "notes"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "agent", "run", "notes"])
         main()
     assert exc_info.value.code == 0
 
 
-def test_agent_unknown():
+def test_agent_unknown(monkeypatch):
     """Test agent run with unknown agent name."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "agent", "run", "unknown"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "agent", "run", "unknown"])
         main()
     assert exc_info.value.code == 2
 
 
-def test_shell_subcommand():
+def test_shell_subcommand(monkeypatch):
     """Test shell subcommand."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "shell"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "shell"])
         main()
     assert exc_info.value.code == 0
 
 
-def test_setup_subcommand():
+def test_setup_subcommand(monkeypatch):
     """Test setup subcommand."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "setup"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "setup"])
         main()
     assert exc_info.value.code == 0
 
 
-def test_setup_c3po_subcommand():
+def test_setup_c3po_subcommand(monkeypatch):
     """Test setup-c3po subcommand."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "setup-c3po", "http://example.com", "token"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "setup-c3po", "http://example.com", "token"])
         main()
     assert exc_info.value.code == 0
 
 
-def test_stream_flags():
+def test_stream_flags(monkeypatch):
     """Test stream-related flags."""
     # --no-stream
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "--no-stream", "-p", "hello"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "--no-stream", "-p", "hello"])
         main()
     assert exc_info.value.code == 0
 
     # -s
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "-s", "-p", "hello"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "-s", "-p", "hello"])
         main()
     assert exc_info.value.code == 0
 
     # -sj
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "-sj", "-p", "hello"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "-sj", "-p", "hello"])
         main()
     assert exc_info.value.code == 0
 
 
-def test_dir_flag():
+def test_dir_flag(monkeypatch):
     """Test -d/--dir flag."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "-d", "/tmp", "-p", "hello"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "-d", "/tmp", "-p", "hello"])
         main()
     assert exc_info.value.code == 0
 
 
-def test_build_flag():
+def test_build_flag(monkeypatch):
     """Test -b/--build flag."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "-b", "-p", "hello"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "-b", "-p", "hello"])
         main()
     assert exc_info.value.code == 0
 
 
-def test_agent_run_once_flag():
+def test_agent_run_once_flag(monkeypatch):
     """Test --once flag is recognized by agent run."""
     with pytest.raises(SystemExit) as exc_info:
-        sys.argv = ["claude-docker", "agent", "run", "notes", "--once"]
+        monkeypatch.setattr(sys, "argv", ["claude-docker", "agent", "run", "notes", "--once"])
+        main()
+    assert exc_info.value.code == 0
+
+
+@pytest.mark.parametrize("argv, expected", [
+    ([], (True, False)),
+    (["--no-stream"], (False, False)),
+    (["-sj"], (True, True)),
+    (["--stream-json"], (True, True)),
+    (["--no-stream", "--stream"], (True, False)),
+    (["-sj", "--no-stream"], (False, False)),
+    (["--no-stream", "agent", "-sj"], (True, True)),
+    (["-sj", "agent"], (True, True)),
+])
+def test_agent_run_stream_flags(monkeypatch, argv, expected):
+    """Test stream flags before or after 'agent' resolve with the last one winning."""
+    import claude_docker as cd
+    calls = []
+    monkeypatch.setattr(cd, "run_container",
+                        lambda args, stream=True, stream_raw=False: calls.append((stream, stream_raw)) or 0)
+    if "agent" not in argv:
+        argv = argv + ["agent"]
+    with pytest.raises(SystemExit) as exc_info:
+        monkeypatch.setattr(sys, "argv", ["claude-docker", *argv, "run", "notes"])
         main()
     assert exc_info.value.code == 0
+    assert calls == [expected]
+
+
+@pytest.mark.parametrize("argv, expected", [
+    (["-p", "hello"], []),
+    (["-p", "shell"], []),
+    (["-d", "/tmp", "--no-stream", "-p", "hi"], []),
+    (["--no-stream", "agent", "run", "notes"], ["agent"]),
+    (["shell"], ["shell"]),
+    (["-h"], "all"),
+    (["bogus"], "all"),
+    (["--pro", "hi"], "all"),
+])
+def test_subcommands_to_build(argv, expected):
+    """Test that only the subparsers reachable from argv are built."""
+    from claude_docker import _subcommands_to_build, SUBCMD_BUILDERS
+    if expected == "all":
+        expected = list(SUBCMD_BUILDERS)
+    assert _subcommands_to_build(argv) == expected
+
+
+def test_parser_built_once_per_subcommand_set(monkeypatch):
+    """Test that repeated main() calls reuse the cached parser."""
+    from claude_docker import _build_parser
+    _build_parser.cache_clear()
+    for _ in range(3):
+        with pytest.raises(SystemExit):
+            monkeypatch.setattr(sys, "argv", ["claude-docker", "agent", "list"])
+            main()
+    info = _build_parser.cache_info()
+    assert (info.misses, info.hits) == (1, 2)
@@ -51,6 +51,14 @@ def test_encode_decode_complex():
     assert decoded == original
 
 
+def test_encode_decode_unicode():
+    """Test non-ASCII commands survive the round trip as UTF-8 JSON."""
+    original = ["echo 'héllo wörld'", "echo ✓"]
+    encoded = encode_init_commands(original)
+    assert json.loads(base64.b64decode(encoded).decode("utf-8")) == original
+    assert decode_init_commands(encoded) == original
+
+
 def test_decode_invalid_base64():
     """Test decoding invalid base64 string."""
     with pytest.raises(Exception):
@@ -3,53 +3,94 @@
 import json
 import pytest
 from unittest.mock import patch, MagicMock
-from claude_docker import detect_runtime, build_hash, needs_rebuild, claude_docker
+from claude_docker import (
+    detect_runtime, build_hash, build_image, exec_container, exec_formatted_container, needs_rebuild, claude_docker,
+)
 
 
 @pytest.fixture(autouse=True)
 def reset_runtime_cache():
-    """Reset the cached runtime between tests."""
+    """Reset the cached runtime and image inspect results between tests."""
     claude_docker._runtime = None
+    claude_docker._image_hashes.clear()
     yield
     claude_docker._runtime = None
+    claude_docker._image_hashes.clear()
 
 
 def test_detect_runtime_docker():
     """Test detecting docker runtime."""
-    with patch('subprocess.run') as mock_run:
-        mock_run.return_value = MagicMock(returncode=0)
+    with patch('shutil.which') as mock_which:
+        mock_which.side_effect = lambda name: f"/usr/bin/{name}"
         assert detect_runtime() == "docker"
 
 
 def test_detect_runtime_nerdctl():
     """Test detecting nerdctl runtime when docker is not available."""
-    with patch('subprocess.run') as mock_run:
-        mock_run.side_effect = [
-            MagicMock(returncode=1),  # docker not found
-            MagicMock(returncode=0),  # nerdctl found
-        ]
+    with patch('shutil.which') as mock_which:
+        mock_which.side_effect = lambda name: "/usr/bin/nerdctl" if name == "nerdctl" else None
         assert detect_runtime() == "nerdctl"
 
 
 def test_detect_runtime_finch():
     """Test detecting finch runtime when docker and nerdctl are not available."""
-    with patch('subprocess.run') as mock_run:
-        mock_run.side_effect = [
-            MagicMock(returncode=1),  # docker not found
-            MagicMock(returncode=1),  # nerdctl not found
-            MagicMock(returncode=0),  # finch found
-        ]
+    with patch('shutil.which') as mock_which:
+        mock_which.side_effect = lambda name: "/usr/local/bin/finch" if name == "finch" else None
         assert detect_runtime() == "finch"
 
 
 def test_detect_runtime_no_runtime():
     """Test error when no runtime found."""
-    with patch('subprocess.run') as mock_run:
-        mock_run.return_value = MagicMock(returncode=1)
+    with patch('shutil.which') as mock_which:
+        mock_which.return_value = None
         with pytest.raises(SystemExit):
             detect_runtime()
 
 
+def test_detect_runtime_cached():
+    """Test that runtime detection only probes PATH once per process."""
+    with patch('shutil.which') as mock_which:
+        mock_which.side_effect = lambda name: f"/usr/bin/{name}"
+        assert detect_runtime() == "docker"
+        assert detect_runtime() == "docker"
+        assert mock_which.call_count == 1
+
+
+def test_runtime_cache_written_after_probe(tmp_path, monkeypatch):
+    """Test that a successful runtime probe is persisted for later runs."""
+    cache = tmp_path / ".runtime"
+    monkeypatch.setattr("claude_docker.RUNTIME_CACHE_FILE", cache)
+    monkeypatch.setattr(claude_docker, "_needs_sudo", None)
+    with patch('shutil.which') as mock_which:
+        mock_which.side_effect = lambda name: f"/usr/bin/{name}"
+        assert claude_docker.runtime_cmd == ["docker"]
+    assert json.loads(cache.read_text()) == {"runtime": "docker", "sudo": False}
+
+
+def test_runtime_cache_skips_detection(tmp_path, monkeypatch):
+    """Test that a fresh runtime cache skips PATH detection and the sudo probe."""
+    cache = tmp_path / ".runtime"
+    cache.write_text(json.dumps({"runtime": "nerdctl", "sudo": True}))
+    monkeypatch.setattr("claude_docker.RUNTIME_CACHE_FILE", cache)
+    monkeypatch.setattr(claude_docker, "_needs_sudo", None)
+    with patch('shutil.which') as mock_which, patch('subprocess.run') as mock_run:
+        mock_which.side_effect = lambda name: f"/usr/bin/{name}"
+        assert claude_docker.runtime_cmd == ["sudo", "nerdctl"]
+        mock_run.assert_not_called()
+
+
+def test_runtime_cache_expired(tmp_path, monkeypatch):
+    """Test that a runtime cache older than the TTL is ignored."""
+    import os
+    cache = tmp_path / ".runtime"
+    cache.write_text(json.dumps({"runtime": "nerdctl", "sudo": True}))
+    os.utime(cache, (0, 0))
+    monkeypatch.setattr("claude_docker.RUNTIME_CACHE_FILE", cache)
+    with patch('shutil.which') as mock_which:
+        mock_which.side_effect = lambda name: f"/usr/bin/{name}"
+        assert detect_runtime() == "docker"
+
+
 def test_build_hash():
     """Test build hash calculation."""
     hash1 = build_hash()
@@ -64,6 +105,29 @@ def test_build_hash_consistency():
     assert len(set(hashes)) == 1  # All hashes should be identical
 
 
+def test_build_hash_disk_cache(tmp_path, monkeypatch):
+    """Test that the build hash is persisted and reused while the files are unchanged."""
+    import claude_docker as cd
+    cache = tmp_path / ".build-hash-cache"
+    monkeypatch.setattr(cd, "BUILD_HASH_CACHE_FILE", cache)
+    build_hash.cache_clear()
+    expected = build_hash()
+    assert json.loads(cache.read_text())["hash"] == expected
+
+    build_hash.cache_clear()
+    with patch.object(cd, "_hash_build_files", side_effect=AssertionError("rehashed")):
+        assert build_hash() == expected
+
+    # A stale key forces a rehash
+    entry = json.loads(cache.read_text())
+    entry["key"][0][1] -= 1
+    entry["hash"] = "stale"
+    cache.write_text(json.dumps(entry))
+    build_hash.cache_clear()
+    assert build_hash() == expected
+    build_hash.cache_clear()
+
+
 def test_needs_rebuild_no_image():
     """Test rebuild when image doesn't exist."""
     with patch('subprocess.run') as mock_run:
@@ -126,3 +190,84 @@ def test_needs_rebuild_nerdctl_dict_format():
     with patch('subprocess.run') as mock_run:
         mock_run.return_value = MagicMock(returncode=0, stdout=image_json)
         assert needs_rebuild("nerdctl") is False
+
+
+def test_needs_rebuild_caches_inspect():
+    """Test that image inspect runs once per runtime within a process."""
+    current_hash = build_hash()
+    image_json = json.dumps([{"Config": {"Labels": {"build.hash": current_hash}}}])
+    with patch('subprocess.run') as mock_run:
+        mock_run.return_value = MagicMock(returncode=0, stdout=image_json)
+        assert needs_rebuild("docker") is False
+        assert needs_rebuild("docker") is False
+        assert mock_run.call_count == 1
+
+
+def test_build_image_caches_from_existing_image():
+    """Test that rebuilding reuses the existing image as a BuildKit cache source."""
+    image_json = json.dumps([{"Config": {"Labels": {"build.hash": "stale-hash"}}}])
+    with patch('subprocess.run') as mock_run:
+        mock_run.return_value = MagicMock(returncode=0, stdout=image_json)
+        build_image("docker")
+    build_call = next(c for c in mock_run.call_args_list if c.args[0][1] == "build")
+    cmd = build_call.args[0]
+    assert cmd[cmd.index("--cache-from") + 1] == "claude-code"
+    assert "BUILDKIT_INLINE_CACHE=1" in cmd
+    assert build_call.kwargs["env"]["DOCKER_BUILDKIT"] == "1"
+
+
+def test_build_image_sudo_sets_no_env_assignment():
+    """Test that sudo builds pass no VAR=value to sudo and no custom env."""
+    with patch('subprocess.run') as mock_run:
+        mock_run.return_value = MagicMock(returncode=0, stdout="")
+        build_image(["sudo", "docker"])
+    build_call = next(c for c in mock_run.call_args_list if "build" in c.args[0])
+    assert build_call.args[0][:3] == ["sudo", "docker", "build"]
+    assert not any("=" in arg for arg in build_call.args[0][:2])
+    assert build_call.kwargs["env"] is None
+
+
+def test_build_image_nerdctl_skips_docker_cache_flags():
+    """Test that nerdctl builds don't get docker's inline cache or --cache-from."""
+    image_json = json.dumps([{"Config": {"Labels": {"build.hash": "stale-hash"}}}])
+    with patch('subprocess.run') as mock_run:
+        mock_run.return_value = MagicMock(returncode=0, stdout=image_json)
+        build_image(["sudo", "nerdctl"])
+    cmd = next(c for c in mock_run.call_args_list if "build" in c.args[0]).args[0]
+    assert "--cache-from" not in cmd
+    assert "BUILDKIT_INLINE_CACHE=1" not in cmd
+
+
+def test_build_image_no_cache_skips_cache_from():
+    """Test that --no-cache builds don't pass --cache-from."""
+    with patch('subprocess.run') as mock_run:
+        mock_run.return_value = MagicMock(returncode=0, stdout="")
+        build_image("docker", no_cache=True)
+    build_call = next(c for c in mock_run.call_args_list if c.args[0][1] == "build")
+    assert "--no-cache" in build_call.args[0]
+    assert "--cache-from" not in build_call.args[0]
+
+
+def test_exec_formatted_container_pipes_and_traps():
+    """Test that formatted direct runs exec a shell pipeline that stops the container on signals."""
+    with patch('shutil.which', return_value="/usr/bin/format-stream"), \
+            patch('os.execv') as mock_execv:
+        exec_formatted_container(["run", "--rm", "--name", "claude-code-1", "claude-code", "-p", "hi there"])
+    path, argv = mock_execv.call_args.args
+    assert path == "/bin/sh" and argv[:2] == ["/bin/sh", "-c"]
+    script = argv[2]
+    assert "docker stop claude-code-1" in script
+    assert "trap 'stop_container; exit 130' INT TERM" in script
+    assert "docker run --rm --name claude-code-1 claude-code -p 'hi there' | /usr/bin/format-stream &" in script
+    assert script.endswith("wait $!")
+
+
+def test_exec_container_traps_without_pipe():
+    """Test that unformatted direct runs also stop the container on signals."""
+    with patch('shutil.which', return_value="/usr/bin/docker"), \
+            patch('os.execv') as mock_execv:
+        exec_container(["run", "--rm", "--name", "claude-code-1", "claude-code", "-p", "hi"])
+    script = mock_execv.call_args.args[1][2]
+    assert "trap 'stop_container; exit 130' INT TERM" in script
+    assert "docker run --rm --name claude-code-1 claude-code -p hi &" in script
+    assert "format-stream" not in script
@@ -0,0 +1,66 @@
+"""Test token extraction from `claude setup-token` output."""
+
+from claude_docker import _extract_token, _strip_ansi, _TOKEN_RE, _TOKEN_FALLBACK_RE
+
+
+def test_strip_ansi_removes_color_codes():
+    """Test stripping SGR color sequences."""
+    assert _strip_ansi("\x1b[1m\x1b[32mhello\x1b[0m world") == "hello world"
+
+
+def test_strip_ansi_non_letter_final_byte():
+    """Test stripping CSI sequences whose final byte is not a letter."""
+    assert _strip_ansi("a\x1b[2~b\x1b[?25@c") == "abc"
+
+
+def test_strip_ansi_plain_text_unchanged():
+    """Test that text without escapes is returned unchanged."""
+    assert _strip_ansi("no escapes here") == "no escapes here"
+
+
+def test_strip_ansi_unterminated_sequence_kept():
+    """Test that a trailing unterminated sequence is left in place."""
+    assert _strip_ansi("abc\x1b[12;3") == "abc\x1b[12;3"
+
+
+def test_token_extracted_after_stripping():
+    """Test extracting a token wrapped in color codes."""
+    token = "sk-ant-" + "a" * 95
+    out = f"Your token:\n\x1b[1m{token}\x1b[0m\nStore it safely."
+    m = _TOKEN_RE.search(_strip_ansi(out))
+    assert m and m.group(1) == token
+
+
+def test_token_fallback_pattern():
+    """Test the length-based fallback when the token is followed by other text."""
+    token = "sk-at-" + "b" * 100
+    clean = f"token={token}'"
+    assert _TOKEN_RE.search(clean) is None
+    m = _TOKEN_FALLBACK_RE.search(clean)
+    assert m and m.group(1) == token
+
+
+def test_extract_token_plain_output():
+    """Test output without escape sequences."""
+    token = "sk-ant-" + "b" * 95
+    assert _extract_token(f"Your token: {token}\nDone.") == token
+
+
+def test_extract_token_glued_by_escape_codes():
+    """Test a token split by escape codes is only found after stripping."""
+    token = "sk-ant-" + "c" * 95
+    out = f"\x1b[1m{token[:50]}\x1b[0m{token[50:]}\n"
+    assert _extract_token(out) == token
+
+
+def test_extract_token_prefers_first_token():
+    """Test that a split first token wins over a later intact one."""
+    first = "sk-ant-" + "d" * 95
+    second = "sk-ant-" + "e" * 95
+    out = f"\x1b[1m{first[:50]}\x1b[0m{first[50:]}\nOld: {second}\n"
+    assert _extract_token(out) == first
+
+
+def test_extract_token_missing():
+    """Test output without a token."""
+    assert _extract_token("\x1b[31mError: not logged in\x1b[0m\n") is None
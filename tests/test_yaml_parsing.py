@@ -2,9 +2,7 @@
 
 import os
 import pytest
-import tempfile
 import yaml
-from pathlib import Path
 from unittest.mock import patch
 from claude_docker import load_agents, get_agent_config, AGENTS_FILE
 
@@ -51,7 +49,7 @@ def test_get_agent_config_simple():
     assert config.workspace == os.path.expanduser("~/Documents/Notes")
     assert config.model is None
     assert config.env == {}
-    assert config.init == []
+    assert config.init == ()
 
 
 def test_get_agent_config_block():
@@ -110,12 +108,12 @@ worker:
 
 
 def test_get_agent_config_triggers_empty_default():
-    """Test that missing triggers/post_run default to empty lists."""
+    """Test that missing triggers/post_run default to empty tuples."""
     agents = {"notes": "~/Documents/Notes"}
     config = get_agent_config("notes", agents)
     assert config is not None
-    assert config.triggers == []
-    assert config.post_run == []
+    assert config.triggers == ()
+    assert config.post_run == ()
 
 
 def test_get_agent_config_readonly_true():
@@ -139,74 +137,76 @@ def test_get_agent_config_readonly_default():
     assert config.readonly is False
 
 
-def test_load_agents_migrates_simple_format():
+@pytest.fixture
+def agents_file(tmp_path, monkeypatch):
+    """Point AGENTS_FILE at a fresh file under tmp_path."""
+    path = tmp_path / "agents.yaml"
+    monkeypatch.setattr("claude_docker.AGENTS_FILE", path)
+    return path
+
+
+def test_load_agents_migrates_simple_format(agents_file):
     """load_agents converts simple string format to dict with prompt: /c3po auto."""
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".yaml", delete=False) as f:
-        f.write("notes: ~/Documents/Notes\n")
-        tmp = Path(f.name)
-    try:
-        with patch("claude_docker.AGENTS_FILE", tmp):
-            data = load_agents()
-        assert data["notes"]["workspace"] == "~/Documents/Notes"
-        assert data["notes"]["prompt"] == "/c3po auto"
-        # File was updated too
-        on_disk = yaml.safe_load(tmp.read_text())
-        assert on_disk["notes"]["prompt"] == "/c3po auto"
-    finally:
-        tmp.unlink()
-
-
-def test_load_agents_migrates_dict_no_prompt():
+    agents_file.write_text("notes: ~/Documents/Notes\n")
+    data = load_agents()
+    assert data["notes"]["workspace"] == "~/Documents/Notes"
+    assert data["notes"]["prompt"] == "/c3po auto"
+    # File was updated too
+    on_disk = yaml.safe_load(agents_file.read_text())
+    assert on_disk["notes"]["prompt"] == "/c3po auto"
+
+
+def test_load_agents_migrates_dict_no_prompt(agents_file):
     """load_agents adds prompt: /c3po auto to dict agents without prompt or triggers."""
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".yaml", delete=False) as f:
-        yaml.dump({"coder": {"workspace": "~/Code/project", "model": "opus"}}, f)
-        tmp = Path(f.name)
-    try:
-        with patch("claude_docker.AGENTS_FILE", tmp):
-            data = load_agents()
-        assert data["coder"]["prompt"] == "/c3po auto"
-        assert data["coder"]["model"] == "opus"
-    finally:
-        tmp.unlink()
-
-
-def test_load_agents_skips_existing_prompt():
+    agents_file.write_text("coder:\n  workspace: ~/Code/project\n  model: opus\n")
+    data = load_agents()
+    assert data["coder"]["prompt"] == "/c3po auto"
+    assert data["coder"]["model"] == "opus"
+
+
+def test_load_agents_skips_existing_prompt(agents_file):
     """load_agents does not touch agents that already have a prompt."""
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".yaml", delete=False) as f:
-        yaml.dump({"worker": {"workspace": "~/Code/worker", "prompt": "Do stuff."}}, f)
-        tmp = Path(f.name)
-    try:
-        with patch("claude_docker.AGENTS_FILE", tmp):
-            data = load_agents()
-        assert data["worker"]["prompt"] == "Do stuff."
-    finally:
-        tmp.unlink()
-
-
-def test_load_agents_skips_triggers():
+    agents_file.write_text("worker:\n  workspace: ~/Code/worker\n  prompt: Do stuff.\n")
+    data = load_agents()
+    assert data["worker"]["prompt"] == "Do stuff."
+
+
+def test_load_agents_skips_triggers(agents_file):
     """load_agents does not inject prompt for agents that have triggers."""
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".yaml", delete=False) as f:
-        yaml.dump({"bot": {"workspace": "~/Code/bot", "triggers": [{"type": "c3po"}]}}, f)
-        tmp = Path(f.name)
-    try:
-        with patch("claude_docker.AGENTS_FILE", tmp):
-            data = load_agents()
-        assert "prompt" not in data["bot"]
-    finally:
-        tmp.unlink()
-
-
-def test_load_agents_migration_idempotent():
+    agents_file.write_text("bot:\n  workspace: ~/Code/bot\n  triggers:\n    - type: c3po\n")
+    data = load_agents()
+    assert "prompt" not in data["bot"]
+
+
+def test_load_agents_migration_idempotent(agents_file):
     """load_agents migration is idempotent: second load does not re-write the file."""
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".yaml", delete=False) as f:
-        f.write("notes: ~/Documents/Notes\n")
-        tmp = Path(f.name)
-    try:
-        with patch("claude_docker.AGENTS_FILE", tmp):
-            load_agents()
-            content_after_first = tmp.read_text()
-            load_agents()
-            content_after_second = tmp.read_text()
-        assert content_after_first == content_after_second
-    finally:
-        tmp.unlink()
+    agents_file.write_text("notes: ~/Documents/Notes\n")
+    load_agents()
+    content_after_first = agents_file.read_text()
+    load_agents()
+    assert agents_file.read_text() == content_after_first
+
+
+def test_load_agents_uses_cache_when_unchanged(agents_file):
+    """Second load of an unchanged file is served from the cache without YAML parsing."""
+    agents_file.write_text("worker:\n  workspace: ~/Code/worker\n  prompt: Do stuff.\n")
+    first = load_agents()
+    with patch("yaml.load", side_effect=AssertionError("YAML was re-parsed")):
+        second = load_agents()
+    assert first == second
+
+
+def test_load_agents_cache_invalidated_on_change(agents_file):
+    """Editing agents.yaml invalidates the cached parse."""
+    agents_file.write_text("worker:\n  workspace: ~/Code/worker\n  prompt: Do stuff.\n")
+    load_agents()
+    agents_file.write_text("worker:\n  workspace: ~/Code/other\n  prompt: Do more stuff.\n")
+    data = load_agents()
+    assert data["worker"]["workspace"] == "~/Code/other"
+
+
+@pytest.mark.parametrize("path", ["~", "~/Code/project", "~/", "/abs/path", "relative", "~root/x", ""])
+def test_expand_home_matches_expanduser(path):
+    """Test the ~ fast path agrees with os.path.expanduser."""
+    from claude_docker import _expand_home
+    assert _expand_home(path) == os.path.expanduser(path)